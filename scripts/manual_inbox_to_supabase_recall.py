@@ -1,27 +1,51 @@
 import os
-import json
+import orjson
+import logging
+import logging.handlers
+import sys
 import csv
 import re
 import base64
+import random
+import tempfile
+import threading
 import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from functools import lru_cache
 from datetime import datetime
+from email import message_from_bytes, policy as email_policy
 from dateutil import parser
 from pathlib import Path
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
-import PyPDF2
-from PyPDF2 import PdfMerger
+from googleapiclient.errors import HttpError
+import pikepdf
 import pdfplumber
+import pypdfium2 as pdfium
 from io import BytesIO
 from dotenv import load_dotenv
 from supabase import create_client, Client
 import openai
+from rapidfuzz import process as fuzz_process
+from rapidfuzz.distance import Levenshtein
 
 # Load environment variables from parent directory (root of project)
 root_dir = Path(__file__).parent.parent
 env_path = root_dir / '.env.local'
 load_dotenv(env_path)
 
+# Progress lines go to stderr in blocks of LOG_BUFFER_RECORDS (warnings and errors flush immediately)
+LOG_BUFFER_RECORDS = 100
+logger = logging.getLogger('fleet')
+logger.setLevel(logging.INFO)
+_stderr_handler = logging.StreamHandler(sys.stderr)
+_stderr_handler.setFormatter(logging.Formatter('%(message)s'))
+logger.addHandler(logging.handlers.MemoryHandler(
+    LOG_BUFFER_RECORDS, flushLevel=logging.WARNING, target=_stderr_handler
+))
+
 # ============================================
 ## CONFIGURATION
 # ============================================
@@ -35,9 +59,62 @@ SHEETS_SERVICE_ACCOUNT_JSON = os.environ.get('GOOGLE_SERVICE_ACCOUNT_SHEETS')
 SPREADSHEET_ID = os.environ.get('GOOGLE_SHEET_ID')  # Should be the invoice logging sheet
 
 # CONSERVATIVE RATE LIMITING
-DELAY_BETWEEN_EMAILS = 3
-BATCH_SIZE = 20
-BATCH_DELAY = 30
+# One token bucket per Google API, kept under the per-user quotas
+# Gmail: 250 quota units/sec per user, counted in units per method -> 200/sec leaves headroom.
+# Capacity stays within one second of quota and must cover a full batch request
+# (each call in a batch counts against quota).
+GMAIL_UNITS_PER_SECOND = 200
+GMAIL_BURST_UNITS = 250
+GMAIL_QUOTA_UNITS = {
+    'labels.list': 1,
+    'labels.create': 5,
+    'messages.list': 5,
+    'messages.get': 5,
+    'messages.batchModify': 50,
+}
+# Sheets: 60 requests/min per user
+SHEETS_CALLS_PER_SECOND = 1
+SHEETS_BURST = 5
+# Buffered sheet rows (and their emails' label moves) are sent once at least this many are queued
+SHEET_FLUSH_ROWS = 100
+
+# Emails handled concurrently (each mostly waits on Gmail/OpenAI/Supabase)
+MAX_WORKERS = 8
+
+# Calls per Gmail batch HTTP request (the API allows 100) - 50 messages.get = 250 units,
+# so a full batch fits in GMAIL_BURST_UNITS
+GMAIL_BATCH_LIMIT = 50
+GMAIL_BATCH_RETRIES = 3
+# messages.list returns at most 500 IDs per page
+GMAIL_LIST_PAGE_SIZE = 500
+# messages.batchModify accepts at most 1000 message IDs per call
+GMAIL_BATCH_MODIFY_LIMIT = 1000
+
+# Headers needed by the metadata-only pre-filter pass
+METADATA_HEADERS = ['Subject', 'From']
+
+# Invoice details are on the first page(s) - cap what gets parsed and sent to OpenAI
+MAX_PDF_PAGES = 2
+MAX_PROMPT_CHARS = 4000
+VIN_PATTERN = re.compile(r'\b[A-HJ-NPR-Z0-9]{17}\b')
+
+# PDFium is not thread-safe, even across separate documents
+PDFIUM_LOCK = threading.Lock()
+
+# Patterns applied to every email, compiled once
+COMPANY_SPAN_PATTERN = re.compile(r'<span[^>]*>([^<]+)</span>')
+HTML_TAG_PATTERN = re.compile(r'<[^>]*>')
+INVOICE_NUMBER_PATTERN = re.compile(r'invoice[-_\s]*(\d+)', re.IGNORECASE)
+
+# Retry transient API errors (429/5xx, rate limit, quota) with exponential backoff - 5 attempts in all
+API_MAX_RETRIES = 4
+# 429/503 mean the request was refused; after 500/502/504 it may still have been applied,
+# so those are only retried for idempotent calls
+API_REFUSED_STATUSES = (429, 503)
+API_RETRYABLE_STATUSES = API_REFUSED_STATUSES + (500, 502, 504)
+API_BACKOFF_BASE = 2
+API_BACKOFF_MAX = 60
+COMPANY_MATCH_CACHE_SIZE = 1024  # distinct extracted names whose fuzzy match is remembered
 
 # Supabase
 SUPABASE_URL = os.environ.get('NEXT_PUBLIC_SUPABASE_URL')
@@ -45,23 +122,168 @@ SUPABASE_KEY = os.environ.get('SUPABASE_SERVICE_ROLE_KEY')
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
 
 if not all([SUPABASE_URL, SUPABASE_KEY, OPENAI_API_KEY, SPREADSHEET_ID, GMAIL_SERVICE_ACCOUNT_JSON]):
-    print("ERROR: Missing required environment variables")
-    print("Required: NEXT_PUBLIC_SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY, OPENAI_API_KEY, GOOGLE_SHEET_ID, GOOGLE_SERVICE_ACCOUNT_GMAIL")
+    logger.error("ERROR: Missing required environment variables")
+    logger.error("Required: NEXT_PUBLIC_SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY, OPENAI_API_KEY, GOOGLE_SHEET_ID, GOOGLE_SERVICE_ACCOUNT_GMAIL")
     exit(1)
 
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 openai.api_key = OPENAI_API_KEY
 
+def _is_rate_limited(error):
+    """Check if a Gmail API error is a per-request rate/serving limit that can be retried"""
+    if not isinstance(error, HttpError):
+        return False
+    if error.resp.status == 429:
+        return True
+    if error.resp.status == 403:
+        content = error.content.decode('utf-8', errors='ignore') if error.content else ''
+        return any(reason in content for reason in
+                   ('rateLimitExceeded', 'userRateLimitExceeded', 'servingLimitExceeded'))
+    return False
+
+def _is_transient_error(error, retry_5xx=True):
+    """Check if an API error is a temporary rate limit / availability issue worth retrying"""
+    if _is_rate_limited(error) or isinstance(error, openai.RateLimitError):
+        return True
+    statuses = API_RETRYABLE_STATUSES if retry_5xx else API_REFUSED_STATUSES
+    if isinstance(error, HttpError) and error.resp.status in statuses:
+        return True
+    if getattr(error, 'status_code', None) in statuses:
+        return True
+    message = str(error).lower()
+    return 'rate limit' in message or 'quota' in message
+
+def _is_duplicate_upload(error):
+    """Check if a storage upload failed only because the file already exists"""
+    if str(getattr(error, 'status', '')) == '409':
+        return True
+    message = str(error)
+    return 'Duplicate' in message or 'already exists' in message
+
+class RateLimiter:
+    """Thread-safe token bucket: refills at `rate` tokens/second, holds at most `capacity`"""
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self, tokens=1):
+        """Block only until enough tokens are available, then take them"""
+        # A request larger than the bucket could never be satisfied
+        tokens = min(tokens, self.capacity)
+        
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                
+                time.sleep((tokens - self.tokens) / self.rate)
+    
+    def limit(self, fn, tokens=1):
+        """Wrap fn so that every call (including retries) first takes tokens from the bucket"""
+        def limited(*args, **kwargs):
+            self.acquire(tokens)
+            return fn(*args, **kwargs)
+        return limited
+
+@dataclass
+class EmailView:
+    """Gmail message parsed once: headers, text bodies and decoded PDF attachments"""
+    id: str
+    thread_id: str
+    label_ids: list
+    headers: dict
+    bodies: dict = field(default_factory=dict)  # 'plain' / 'html' -> decoded body text
+    pdf_parts: list = field(default_factory=list)  # {'filename', 'data'} with the PDF bytes
+    
+    @classmethod
+    def from_message(cls, message):
+        """Build a header-only view from a Gmail API message fetched with format='metadata'"""
+        headers = {}
+        for header in message.get('payload', {}).get('headers', []):
+            # Keep the first value, as the old next(...) scans did
+            headers.setdefault(header['name'], header['value'])
+        
+        return cls(
+            id=message.get('id', ''),
+            thread_id=message.get('threadId', ''),
+            label_ids=message.get('labelIds', []),
+            headers=headers
+        )
+    
+    @classmethod
+    def from_raw(cls, message):
+        """Build a full view from a format='raw' message, parsing the RFC 822 bytes in one pass"""
+        parsed = message_from_bytes(base64.urlsafe_b64decode(message['raw']), policy=email_policy.default)
+        
+        headers = {}
+        for name, value in parsed.items():
+            headers.setdefault(name, str(value))
+        
+        view = cls(
+            id=message.get('id', ''),
+            thread_id=message.get('threadId', ''),
+            label_ids=message.get('labelIds', []),
+            headers=headers
+        )
+        
+        for part in parsed.walk():
+            filename = part.get_filename() or ''
+            content_type = part.get_content_type()
+            if filename.lower().endswith('.pdf'):
+                data = part.get_payload(decode=True)
+                if data is not None:
+                    view.pdf_parts.append({'filename': filename, 'data': data})
+            elif content_type in ('text/plain', 'text/html') and not part.is_attachment():
+                try:
+                    text = part.get_content()
+                except (LookupError, UnicodeError):
+                    # Unknown or wrong charset - keep what decodes so the company can still be found
+                    text = (part.get_payload(decode=True) or b'').decode('utf-8', 'replace')
+                view.bodies.setdefault(content_type[len('text/'):], text)
+        
+        return view
+
 class FleetEmailProcessor:
     def __init__(self):
-        self.gmail_service = self._init_gmail_service()
-        self.sheets_service = self._init_sheets_service()
+        # httplib2 connections are not thread-safe, so each worker thread builds its own services
+        self._local = threading.local()
+        self.counter_lock = threading.Lock()
+        self.sheet_lock = threading.Lock()
+        self.move_lock = threading.Lock()
+        self.pending_moves = {}  # message_id -> modify body, flushed once per chunk
+        self.pending_rows = {}  # sheet row number -> row values (new or existing), sent by flush_sheet
+        
         self.processed_count = 0
         self.failed_count = 0
         self.skipped_count = 0
         self.cleaned_count = 0  # Track cleanup actions
+        self.gmail_limiter = RateLimiter(rate=GMAIL_UNITS_PER_SECOND, capacity=GMAIL_BURST_UNITS)
+        self.sheets_limiter = RateLimiter(rate=SHEETS_CALLS_PER_SECOND, capacity=SHEETS_BURST)
         
         self.valid_companies = self._load_valid_companies_from_supabase()
+        self._valid_sorted = tuple(sorted(self.valid_companies))
+        
+        # Fuzzy candidates bucketed by name length - a name whose length differs by more than
+        # max_distance can never be within max_distance edits
+        by_length = defaultdict(list)
+        for company_name in self._valid_sorted:
+            by_length[len(company_name)].append(company_name)
+        self.companies_by_length = {length: tuple(names) for length, names in by_length.items()}
+        
+        # Invoices from the same company repeat within a run - memoize per instance, since
+        # results depend on this instance's company list
+        self._find_fuzzy_match = lru_cache(maxsize=COMPANY_MATCH_CACHE_SIZE)(self._find_fuzzy_match)
+        
+        self._label_name_to_id = self._list_labels()
         self.sorted_label_id = self._get_or_create_label('Batch_2_sorted')
         self.other_label_id = self._get_or_create_label('Other')
         self.batch_labels = self._get_batch_labels()
@@ -69,6 +291,52 @@ class FleetEmailProcessor:
         # Load existing sheet data
         self.sheet_data = self._load_sheet_data()
         self.message_id_to_row = self._build_message_id_map()
+        self._processed_ids = self._load_processed_ids()
+    
+    @property
+    def gmail_service(self):
+        """Gmail API service for the current thread"""
+        if not hasattr(self._local, 'gmail_service'):
+            self._local.gmail_service = self._init_gmail_service()
+        return self._local.gmail_service
+    
+    @property
+    def sheets_service(self):
+        """Sheets API service for the current thread"""
+        if not hasattr(self._local, 'sheets_service'):
+            self._local.sheets_service = self._init_sheets_service()
+        return self._local.sheets_service
+    
+    def _increment(self, counter):
+        """Thread-safe increment of one of the *_count totals"""
+        with self.counter_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+    
+    def _call_with_backoff(self, fn, *args, retry_5xx=True, **kwargs):
+        """Call fn, retrying transient rate limit / server errors with exponential backoff and jitter.
+        Pass retry_5xx=False for non-idempotent calls that a 500/502/504 may have applied anyway."""
+        for attempt in range(API_MAX_RETRIES + 1):
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if attempt == API_MAX_RETRIES or not _is_transient_error(e, retry_5xx):
+                    raise
+                
+                wait = min(API_BACKOFF_MAX, API_BACKOFF_BASE * 2 ** attempt)
+                wait += random.uniform(0, wait / 2)
+                logger.warning(f"  ⏳ Transient error, retrying in {wait:.1f}s: {e}")
+                time.sleep(wait)
+    
+    def _gmail_execute(self, request, method, calls=1, retry_5xx=True):
+        """Execute a Gmail request (or batch of `calls` requests) through the Gmail token bucket with backoff"""
+        return self._call_with_backoff(
+            self.gmail_limiter.limit(request.execute, tokens=GMAIL_QUOTA_UNITS[method] * calls),
+            retry_5xx=retry_5xx
+        )
+    
+    def _sheets_execute(self, request, retry_5xx=True):
+        """Execute a Sheets request through the Sheets token bucket with backoff"""
+        return self._call_with_backoff(self.sheets_limiter.limit(request.execute), retry_5xx=retry_5xx)
     
     def _init_sheets_service(self):
         """Initialize Google Sheets API service"""
@@ -76,10 +344,10 @@ class FleetEmailProcessor:
         
         # Try to use SHEETS service account if available, otherwise fall back to GMAIL
         if SHEETS_SERVICE_ACCOUNT_JSON:
-            service_account_info = json.loads(SHEETS_SERVICE_ACCOUNT_JSON)
+            service_account_info = orjson.loads(SHEETS_SERVICE_ACCOUNT_JSON)
         else:
             # Fallback to Gmail service account
-            service_account_info = json.loads(GMAIL_SERVICE_ACCOUNT_JSON)
+            service_account_info = orjson.loads(GMAIL_SERVICE_ACCOUNT_JSON)
         
         credentials = service_account.Credentials.from_service_account_info(
             service_account_info,
@@ -91,17 +359,17 @@ class FleetEmailProcessor:
     def _load_sheet_data(self):
         """Load all existing data from the Google Sheet"""
         try:
-            result = self.sheets_service.spreadsheets().values().get(
+            result = self._sheets_execute(self.sheets_service.spreadsheets().values().get(
                 spreadsheetId=SPREADSHEET_ID,
                 range='A:H'
-            ).execute()
+            ))
             
             values = result.get('values', [])
-            print(f"Loaded {len(values)} rows from Google Sheet")
+            logger.info(f"Loaded {len(values)} rows from Google Sheet")
             return values
             
         except Exception as e:
-            print(f"ERROR loading sheet data: {e}")
+            logger.error(f"ERROR loading sheet data: {e}")
             return [['Timestamp', 'Message ID', 'Subject', 'Company', 'Invoice File', 'DOT File', 'Status', 'Error']]
     
     def _build_message_id_map(self):
@@ -115,50 +383,63 @@ class FleetEmailProcessor:
                 if message_id:
                     message_map[message_id] = idx
         
-        print(f"Mapped {len(message_map)} message IDs to sheet rows")
+        logger.info(f"Mapped {len(message_map)} message IDs to sheet rows")
         return message_map
     
-    def _is_already_processed(self, message_id):
-        """Check if message was already successfully processed"""
-        if message_id not in self.message_id_to_row:
-            return False
+    def _load_processed_ids(self):
+        """Collect message IDs whose sheet row has status 'success'"""
+        processed_ids = set()
         
-        row_idx = self.message_id_to_row[message_id]
-        row = self.sheet_data[row_idx - 1]  # Convert to 0-indexed
+        for message_id, row_idx in self.message_id_to_row.items():
+            row = self.sheet_data[row_idx - 1]  # Convert to 0-indexed
+            if len(row) >= 7 and row[6] == 'success':  # Column G (Status)
+                processed_ids.add(message_id)
         
-        # Check if status is 'success'
-        if len(row) >= 7:
-            status = row[6]  # Column G (Status)
-            return status == 'success'
-        
-        return False
+        logger.info(f"Found {len(processed_ids)} successfully processed message IDs")
+        return processed_ids
+    
+    def _is_already_processed(self, message_id):
+        """Check if message was already successfully processed"""
+        return message_id in self._processed_ids
     
     def _load_valid_companies_from_supabase(self):
         """Load valid company names from Supabase companies table"""
-        valid_companies = {}
         try:
-            response = supabase.table('companies').select('name').execute()
+            response = self._call_with_backoff(supabase.table('companies').select('name').execute)
             
-            if response.data:
-                for company in response.data:
-                    company_name = company['name']
-                    valid_companies[company_name] = company_name
-            
-            return valid_companies
+            return frozenset(company['name'] for company in response.data or [])
             
         except Exception as e:
-            print(f"ERROR loading companies from Supabase: {e}")
+            logger.error(f"ERROR loading companies from Supabase: {e}")
             exit(1)
     
+    def _list_labels(self):
+        """Fetch the mailbox's labels as {name: id} (None if the request fails)"""
+        try:
+            results = self._gmail_execute(self.gmail_service.users().labels().list(userId='me'), 'labels.list')
+            return {label['name']: label['id'] for label in results.get('labels', [])}
+            
+        except Exception as e:
+            logger.error(f"Error loading labels: {e}")
+            return None
+    
     def _get_or_create_label(self, label_name):
         """Get label ID or create it if it doesn't exist"""
+        # Without a label listing we can't tell whether it exists - don't create a duplicate
+        if self._label_name_to_id is None:
+            return None
+        
         try:
-            results = self.gmail_service.users().labels().list(userId='me').execute()
-            labels = results.get('labels', [])
+            if label_name in self._label_name_to_id:
+                return self._label_name_to_id[label_name]
             
-            for label in labels:
-                if label['name'] == label_name:
-                    return label['id']
+            # Cache miss - the label may have been created since the listing
+            refreshed = self._list_labels()
+            if refreshed is None:
+                return None
+            self._label_name_to_id = refreshed
+            if label_name in refreshed:
+                return refreshed[label_name]
             
             label_object = {
                 'name': label_name,
@@ -166,11 +447,12 @@ class FleetEmailProcessor:
                 'messageListVisibility': 'show'
             }
             
-            created_label = self.gmail_service.users().labels().create(
+            created_label = self._gmail_execute(self.gmail_service.users().labels().create(
                 userId='me',
                 body=label_object
-            ).execute()
+            ), 'labels.create', retry_5xx=False)
             
+            self._label_name_to_id[label_name] = created_label['id']
             return created_label['id']
             
         except Exception as e:
@@ -179,43 +461,54 @@ class FleetEmailProcessor:
     def _get_batch_labels(self):
         """Get all Batch_X_sorted label IDs"""
         batch_labels = {}
-        try:
-            results = self.gmail_service.users().labels().list(userId='me').execute()
-            labels = results.get('labels', [])
-            
-            for label in labels:
-                label_name = label['name']
-                # Match Batch_2_sorted, Batch_3_sorted, Batch_4_sorted, etc.
-                if label_name.startswith('Batch_') and label_name.endswith('_sorted'):
-                    label_id = label['id']
-                    batch_labels[label_id] = label_name
-            
-            print(f"Found {len(batch_labels)} batch labels: {list(batch_labels.values())}")
-            return batch_labels
-            
-        except Exception as e:
-            print(f"Error loading batch labels: {e}")
-            return {}
+        
+        for label_name, label_id in (self._label_name_to_id or {}).items():
+            # Match Batch_2_sorted, Batch_3_sorted, Batch_4_sorted, etc.
+            if label_name.startswith('Batch_') and label_name.endswith('_sorted'):
+                batch_labels[label_id] = label_name
+        
+        logger.info(f"Found {len(batch_labels)} batch labels: {list(batch_labels.values())}")
+        return batch_labels
+    
+    def _queue_label_move(self, message_id, add_label_ids=None):
+        """Queue a label change + INBOX removal; applied in batch by flush_label_moves"""
+        with self.move_lock:
+            self.pending_moves[message_id] = {
+                'addLabelIds': add_label_ids or [],
+                'removeLabelIds': ['INBOX']
+            }
+    
+    def flush_label_moves(self):
+        """Apply all queued label moves with one batchModify per distinct label change"""
+        with self.move_lock:
+            moves, self.pending_moves = self.pending_moves, {}
+        
+        groups = defaultdict(list)  # (add label IDs, remove label IDs) -> message IDs
+        for message_id, body in moves.items():
+            groups[(tuple(body['addLabelIds']), tuple(body['removeLabelIds']))].append(message_id)
+        
+        for (add_label_ids, remove_label_ids), message_ids in groups.items():
+            for start in range(0, len(message_ids), GMAIL_BATCH_MODIFY_LIMIT):
+                batch_ids = message_ids[start:start + GMAIL_BATCH_MODIFY_LIMIT]
+                try:
+                    self._gmail_execute(self.gmail_service.users().messages().batchModify(
+                        userId='me',
+                        body={
+                            'ids': batch_ids,
+                            'addLabelIds': list(add_label_ids),
+                            'removeLabelIds': list(remove_label_ids)
+                        }
+                    ), 'messages.batchModify')
+                except Exception as e:
+                    logger.error(f"  ✗ Error moving {len(batch_ids)} messages: {e}")
     
     def move_to_sorted_label(self, message_id):
         """Move email to Batch_2_sorted label and remove from INBOX"""
         if not self.sorted_label_id:
             return False
         
-        try:
-            self.gmail_service.users().messages().modify(
-                userId='me',
-                id=message_id,
-                body={
-                    'addLabelIds': [self.sorted_label_id],
-                    'removeLabelIds': ['INBOX']
-                }
-            ).execute()
-            
-            return True
-            
-        except Exception as e:
-            return False
+        self._queue_label_move(message_id, [self.sorted_label_id])
+        return True
     
     def move_reply_to_original_label(self, message_id, current_labels):
         """Move reply email back to its original Batch_X_sorted label, or just remove from INBOX"""
@@ -229,57 +522,26 @@ class FleetEmailProcessor:
                 batch_label_name = self.batch_labels[label_id]
                 break
         
-        try:
-            if batch_label_id:
-                # Has batch label - just remove from INBOX
-                self.gmail_service.users().messages().modify(
-                    userId='me',
-                    id=message_id,
-                    body={
-                        'removeLabelIds': ['INBOX']
-                    }
-                ).execute()
-                
-                print(f"  🔙 Kept in {batch_label_name}, removed from INBOX")
-                return True, f"Kept in {batch_label_name}"
-            else:
-                # No batch label - this is a new reply, just remove from INBOX
-                self.gmail_service.users().messages().modify(
-                    userId='me',
-                    id=message_id,
-                    body={
-                        'removeLabelIds': ['INBOX']
-                    }
-                ).execute()
-                
-                print(f"  🗑️  Reply removed from INBOX")
-                return True, "Reply removed from INBOX"
-            
-        except Exception as e:
-            print(f"  ✗ Error moving: {e}")
-            return False, str(e)
+        # Either way the reply only needs to leave INBOX
+        self._queue_label_move(message_id)
+        
+        if batch_label_id:
+            # Has batch label - it stays there
+            logger.info(f"  🔙 Kept in {batch_label_name}, removed from INBOX")
+            return True, f"Kept in {batch_label_name}"
+        else:
+            # No batch label - this is a new reply
+            logger.info(f"  🗑️  Reply removed from INBOX")
+            return True, "Reply removed from INBOX"
     
     def move_to_other_label(self, message_id):
         """Move non-invoice email to Other label and remove from INBOX"""
         if not self.other_label_id:
             return False
         
-        try:
-            self.gmail_service.users().messages().modify(
-                userId='me',
-                id=message_id,
-                body={
-                    'addLabelIds': [self.other_label_id],
-                    'removeLabelIds': ['INBOX']
-                }
-            ).execute()
-            
-            print(f"  📁 Moved to Other label")
-            return True
-            
-        except Exception as e:
-            print(f"  ✗ Error moving to Other: {e}")
-            return False
+        self._queue_label_move(message_id, [self.other_label_id])
+        logger.info(f"  📁 Moved to Other label")
+        return True
     
     def _init_gmail_service(self):
         """Initialize Gmail API service with domain-wide delegation"""
@@ -287,7 +549,7 @@ class FleetEmailProcessor:
                   'https://www.googleapis.com/auth/gmail.modify']
         
         # Parse service account JSON from environment variable
-        service_account_info = json.loads(GMAIL_SERVICE_ACCOUNT_JSON)
+        service_account_info = orjson.loads(GMAIL_SERVICE_ACCOUNT_JSON)
         
         credentials = service_account.Credentials.from_service_account_info(
             service_account_info,
@@ -299,10 +561,10 @@ class FleetEmailProcessor:
     
     def log_to_sheet(self, message_id, subject, company='', invoice_file='', 
                      dot_file='', status='processing', error=''):
-        """Update Google Sheet - either update existing row or append new row"""
+        """Queue a sheet write - either update existing row or add new row (sent by flush_sheet)"""
         timestamp = datetime.now().isoformat()
         
-        values = [[
+        row = [
             timestamp,
             message_id,
             subject[:100],
@@ -311,59 +573,83 @@ class FleetEmailProcessor:
             dot_file or 'N/A',
             status,
             error[:200] if error else ''
-        ]]
+        ]
         
-        try:
+        # Row numbers come from the local cache, so writes must not interleave
+        with self.sheet_lock:
             if message_id in self.message_id_to_row:
-                # UPDATE existing row
+                # UPDATE existing row (or replace a new row not sent yet)
                 row_number = self.message_id_to_row[message_id]
-                range_name = f'A{row_number}:H{row_number}'
-                
-                self.sheets_service.spreadsheets().values().update(
-                    spreadsheetId=SPREADSHEET_ID,
-                    range=range_name,
-                    valueInputOption='RAW',
-                    body={'values': values}
-                ).execute()
-                
-                # Update local cache
-                self.sheet_data[row_number - 1] = values[0]
-                
-                print(f'  📝 Updated row {row_number}: {status}')
+                self.sheet_data[row_number - 1] = row
                 
             else:
-                # APPEND new row
-                self.sheets_service.spreadsheets().values().append(
+                # New row goes right after the last known row
+                row_number = len(self.sheet_data) + 1
+                self.sheet_data.append(row)
+                self.message_id_to_row[message_id] = row_number
+            
+            self.pending_rows[row_number] = row
+            
+            # A later failed row overwrites an earlier success, so keep the set in step
+            if status == 'success':
+                self._processed_ids.add(message_id)
+            else:
+                self._processed_ids.discard(message_id)
+        
+        logger.info(f'  📝 Logged row {row_number}: {status}')
+    
+    def flush_sheet(self):
+        """Send queued sheet rows in one batchUpdate, new rows included at their assigned row numbers.
+        Explicit ranges make the write safe to retry; rows stay queued until it succeeds and
+        False is returned if anything is left unsent."""
+        with self.sheet_lock:
+            if not self.pending_rows:
+                return True
+            
+            rows = self.pending_rows
+            try:
+                self._sheets_execute(self.sheets_service.spreadsheets().values().batchUpdate(
                     spreadsheetId=SPREADSHEET_ID,
-                    range='A:H',
-                    valueInputOption='RAW',
-                    body={'values': values}
-                ).execute()
-                
-                # Add to local cache
-                new_row_number = len(self.sheet_data) + 1
-                self.sheet_data.append(values[0])
-                self.message_id_to_row[message_id] = new_row_number
-                
-                print(f'  📝 Appended new row: {status}')
+                    body={
+                        'valueInputOption': 'RAW',
+                        'data': [
+                            {'range': f'A{row_number}:H{row_number}', 'values': [row]}
+                            for row_number, row in sorted(rows.items())
+                        ]
+                    }
+                ))
+                self.pending_rows = {}
+                logger.info(f'  📝 Sheet: wrote {len(rows)} rows')
+                return True
                 
-        except Exception as e:
-            print(f'  ✗ Error logging to sheet: {e}')
+            except Exception as e:
+                logger.error(f'  ✗ Error logging to sheet (rows kept for the next flush): {e}')
+                return False
+    
+    def flush_pending(self, force=False):
+        """Once SHEET_FLUSH_ROWS rows are buffered (or if forced), send sheet rows, then label moves"""
+        with self.sheet_lock:
+            buffered_rows = len(self.pending_rows)
+        if not force and buffered_rows < SHEET_FLUSH_ROWS:
+            return
+        
+        # An email only leaves INBOX once its row is in the sheet - if the sheet write fails,
+        # the moves stay queued and unlogged emails are picked up again by the next run
+        if self.flush_sheet():
+            self.flush_label_moves()
     
-    def validate_email(self, message):
-        """Check if email meets criteria and return detailed status"""
+    def validate_headers(self, email):
+        """Run the header-only checks (works on format='metadata' messages); returns a rejection or None"""
         try:
-            headers = message['payload'].get('headers', [])
-            subject = next((h['value'] for h in headers if h['name'] == 'Subject'), '')
-            label_ids = message.get('labelIds', [])
+            subject = email.headers.get('Subject', '')
             
             # Check if it's a reply
-            if subject.startswith('Re:') or subject.startswith('RE:'):
+            if subject.startswith(('Re:', 'RE:')):
                 return {
                     'should_process': False,
                     'action': 'move_to_original',
                     'reason': 'Reply email',
-                    'current_labels': label_ids
+                    'current_labels': email.label_ids
                 }
             
             # Check if it's an invoice email by subject pattern
@@ -376,9 +662,7 @@ class FleetEmailProcessor:
                 }
             
             # Check if first message in thread
-            thread_id = message.get('threadId', '')
-            message_id = message.get('id', '')
-            if thread_id != message_id:
+            if email.thread_id != email.id:
                 return {
                     'should_process': False,
                     'action': 'skip',
@@ -386,7 +670,7 @@ class FleetEmailProcessor:
                 }
             
             # Check from header
-            from_header = next((h['value'] for h in headers if h['name'] == 'From'), '')
+            from_header = email.headers.get('From', '')
             if '@gofleetadvisor.com' not in from_header:
                 return {
                     'should_process': False,
@@ -394,20 +678,21 @@ class FleetEmailProcessor:
                     'reason': 'Sender not @gofleetadvisor.com'
                 }
             
-            # Check for invoice attachment
-            has_invoice = False
-            if 'parts' in message['payload']:
-                for part in message['payload']['parts']:
-                    filename = part.get('filename', '').lower()
-                    if filename.startswith('invoice') and filename.endswith('.pdf'):
-                        has_invoice = True
-                        break
-                    if 'parts' in part:
-                        for subpart in part['parts']:
-                            filename = subpart.get('filename', '').lower()
-                            if filename.startswith('invoice') and filename.endswith('.pdf'):
-                                has_invoice = True
-                                break
+            return None
+            
+        except Exception as e:
+            return {
+                'should_process': False,
+                'action': 'skip',
+                'reason': f'Validation error: {str(e)}'
+            }
+    
+    def validate_attachments(self, email):
+        """Check a full message for an invoice PDF attachment and return detailed status"""
+        try:
+            has_invoice = any(
+                part['filename'].lower().startswith('invoice') for part in email.pdf_parts
+            )
             
             if not has_invoice:
                 return {
@@ -429,10 +714,9 @@ class FleetEmailProcessor:
                 'reason': f'Validation error: {str(e)}'
             }
     
-    def get_email_date(self, message):
+    def get_email_date(self, email):
         """Extract email received date and format as MMDDYYYY"""
-        headers = message['payload'].get('headers', [])
-        date_str = next((h['value'] for h in headers if h['name'] == 'Date'), None)
+        date_str = email.headers.get('Date')
         
         if date_str:
             try:
@@ -443,30 +727,28 @@ class FleetEmailProcessor:
         
         return datetime.now().strftime('%m%d%Y')
     
-    def extract_company_name(self, message):
+    def extract_company_name(self, email):
         """Extract company name with three-tier matching: exact, trailing dash, fuzzy"""
         try:
-            plain_text = self._get_email_body(message, 'plain')
+            first_line = self._get_first_line(email)
             company_name = ''
             
-            if plain_text:
-                text_lines = plain_text.split('\n')
-                if len(text_lines) > 0:
-                    first_line = text_lines[0].strip()
-                    # Remove trailing comma and trim again to catch whitespace after comma
-                    if first_line.endswith(','):
-                        company_name = first_line[:-1].strip()
-                    else:
-                        company_name = first_line
+            if first_line:
+                first_line = first_line.strip()
+                # Remove trailing comma and trim again to catch whitespace after comma
+                if first_line.endswith(','):
+                    company_name = first_line[:-1].strip()
+                else:
+                    company_name = first_line
             
             # Fallback to HTML
             if not company_name:
-                html_text = self._get_email_body(message, 'html')
+                html_text = self._get_email_body(email, 'html')
                 if html_text:
-                    match = re.search(r'<span[^>]*>([^<]+)</span>', html_text)
+                    match = COMPANY_SPAN_PATTERN.search(html_text)
                     if match:
                         company_name = match.group(1)
-                        company_name = re.sub(r'<[^>]*>', '', company_name)
+                        company_name = HTML_TAG_PATTERN.sub('', company_name)
                         company_name = company_name.replace('&amp;', '&')
                         company_name = company_name.replace('&nbsp;', ' ')
                         company_name = company_name.strip()
@@ -478,135 +760,111 @@ class FleetEmailProcessor:
             if company_name:
                 company_formatted = company_name.lower().replace(' ', '-')
                 
-                print(f'  Extracted: "{company_name}" -> "{company_formatted}"')
+                logger.info(f'  Extracted: "{company_name}" -> "{company_formatted}"')
                 
                 # 1. Try exact match
                 if company_formatted in self.valid_companies:
-                    print(f'  ✓ Exact match: "{company_formatted}"')
+                    logger.info(f'  ✓ Exact match: "{company_formatted}"')
                     return company_formatted
                 
                 # 2. Try with trailing dash (for companies that legitimately end with dash)
                 with_trailing_dash = company_formatted + '-'
                 if with_trailing_dash in self.valid_companies:
-                    print(f'  ✓ Trailing dash match: "{with_trailing_dash}"')
+                    logger.info(f'  ✓ Trailing dash match: "{with_trailing_dash}"')
                     return with_trailing_dash
                 
                 # 3. Fuzzy match - find closest match within 2 character edits
                 fuzzy_match = self._find_fuzzy_match(company_formatted, max_distance=2)
                 if fuzzy_match:
-                    print(f'  ✓ Fuzzy match: "{company_formatted}" -> "{fuzzy_match}"')
+                    logger.info(f'  ✓ Fuzzy match: "{company_formatted}" -> "{fuzzy_match}"')
                     return fuzzy_match
                 
-                print(f'  ✗ No match found for "{company_formatted}"')
+                logger.info(f'  ✗ No match found for "{company_formatted}"')
                 return None
             
             return None
             
         except Exception as e:
-            print(f'  ✗ Error extracting company: {e}')
+            logger.error(f'  ✗ Error extracting company: {e}')
             return None
     
     def _find_fuzzy_match(self, input_name, max_distance=2):
         """Find closest matching company name using Levenshtein distance"""
-        best_match = None
-        best_distance = max_distance + 1
-        
-        for valid_name in self.valid_companies.keys():
-            distance = self._levenshtein_distance(input_name, valid_name)
-            if distance <= max_distance and distance < best_distance:
-                best_distance = distance
-                best_match = valid_name
-        
-        return best_match
-    
-    def _levenshtein_distance(self, s1, s2):
-        """Calculate Levenshtein distance between two strings"""
-        if len(s1) < len(s2):
-            return self._levenshtein_distance(s2, s1)
-        
-        if len(s2) == 0:
-            return len(s1)
-        
-        previous_row = range(len(s2) + 1)
-        for i, c1 in enumerate(s1):
-            current_row = [i + 1]
-            for j, c2 in enumerate(s2):
-                # Cost of insertions, deletions, or substitutions
-                insertions = previous_row[j + 1] + 1
-                deletions = current_row[j] + 1
-                substitutions = previous_row[j] + (c1 != c2)
-                current_row.append(min(insertions, deletions, substitutions))
-            previous_row = current_row
-        
-        return previous_row[-1]
-    
-    def _get_email_body(self, message, body_type='plain'):
+        length = len(input_name)
+        candidates = [
+            company_name
+            for candidate_length in range(length - max_distance, length + max_distance + 1)
+            for company_name in self.companies_by_length.get(candidate_length, ())
+        ]
+        
+        match = fuzz_process.extractOne(
+            input_name,
+            candidates,
+            scorer=Levenshtein.distance,
+            score_cutoff=max_distance
+        )
+        return match[0] if match else None
+    
+    def _get_email_body(self, email, body_type='plain'):
         """Extract email body"""
-        try:
-            if 'parts' in message['payload']:
-                for part in message['payload']['parts']:
-                    if part['mimeType'] == f'text/{body_type}':
-                        if 'data' in part['body']:
-                            return base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-            elif message['payload']['mimeType'] == f'text/{body_type}':
-                if 'data' in message['payload']['body']:
-                    return base64.urlsafe_b64decode(message['payload']['body']['data']).decode('utf-8')
-        except:
-            pass
+        return email.bodies.get(body_type)
+    
+    def _get_first_line(self, email):
+        """Extract the first line of the plain text body"""
+        body = email.bodies.get('plain')
+        if body:
+            return body.split('\n', 1)[0]
         return None
     
-    def get_attachments(self, message):
-        """Get all PDF attachments from email"""
-        attachments = []
-        
-        def process_part(part):
-            if part.get('filename', '').lower().endswith('.pdf'):
-                if 'attachmentId' in part['body']:
-                    att_id = part['body']['attachmentId']
-                    att = self.gmail_service.users().messages().attachments().get(
-                        userId='me',
-                        messageId=message['id'],
-                        id=att_id
-                    ).execute()
-                    
-                    data = base64.urlsafe_b64decode(att['data'])
-                    attachments.append({
-                        'filename': part['filename'],
-                        'data': data
-                    })
-        
-        if 'parts' in message['payload']:
-            for part in message['payload']['parts']:
-                process_part(part)
-                if 'parts' in part:
-                    for subpart in part['parts']:
-                        process_part(subpart)
-        
-        return attachments
+    def get_attachments(self, email):
+        """Get all PDF attachments from email (already decoded from the raw message)"""
+        return list(email.pdf_parts)
     
     def extract_invoice_number(self, attachments):
         """Extract invoice number from attachment filenames"""
         for att in attachments:
             filename = att['filename'].lower()
             if filename.startswith('invoice'):
-                match = re.search(r'invoice[-_\s]*(\d+)', filename, re.IGNORECASE)
+                match = INVOICE_NUMBER_PATTERN.search(filename)
                 if match:
                     return match.group(1)
         return 'NA'
     
+    def _extract_pdf_text(self, pdf_data):
+        """Extract text from the first MAX_PDF_PAGES pages, stopping once a VIN shows up"""
+        page_texts = []
+        
+        with PDFIUM_LOCK:
+            pdf = pdfium.PdfDocument(pdf_data)
+            try:
+                for page_index in range(min(len(pdf), MAX_PDF_PAGES)):
+                    page = pdf[page_index]
+                    textpage = page.get_textpage()
+                    page_texts.append(textpage.get_text_range())
+                    textpage.close()
+                    page.close()
+                    # Unit, VIN and plate are printed together
+                    if VIN_PATTERN.search(page_texts[-1]):
+                        break
+            finally:
+                pdf.close()
+        
+        # Pages PDFium could not read get a second try with pdfplumber
+        if not all(page_text.strip() for page_text in page_texts):
+            with pdfplumber.open(BytesIO(pdf_data)) as fallback_pdf:
+                for page_index, page_text in enumerate(page_texts):
+                    if not page_text.strip():
+                        page_texts[page_index] = fallback_pdf.pages[page_index].extract_text() or ''
+        
+        return "".join(page_text + "\n" for page_text in page_texts if page_text)
+    
     def extract_metadata_from_pdf(self, pdf_data):
         """Use OpenAI to extract unit, VIN, and plate from PDF"""
         try:
-            pdf_file = BytesIO(pdf_data)
-            text = ""
-            
-            with pdfplumber.open(pdf_file) as pdf:
-                for page in pdf.pages:
-                    page_text = page.extract_text()
-                    if page_text:
-                        text += page_text + "\n"
+            text = self._extract_pdf_text(pdf_data)
             
-            response = openai.chat.completions.create(
+            response = self._call_with_backoff(
+                openai.chat.completions.create,
                 model="gpt-3.5-turbo",
                 messages=[
                     {
@@ -620,14 +878,14 @@ class FleetEmailProcessor:
                     },
                     {
                         "role": "user",
-                        "content": text
+                        "content": text[:MAX_PROMPT_CHARS]
                     }
                 ],
                 temperature=0,
                 response_format={"type": "json_object"}
             )
             
-            metadata = json.loads(response.choices[0].message.content)
+            metadata = orjson.loads(response.choices[0].message.content)
             
             unit = (metadata.get('unit', 'NA') or 'NA').upper().replace(' ', '').strip()
             vin = (metadata.get('vin', 'NA') or 'NA').upper().replace(' ', '').strip()
@@ -646,64 +904,81 @@ class FleetEmailProcessor:
             return {'unit': 'NA', 'vin': 'NA', 'plate': 'NA'}
     
     def merge_pdfs(self, pdf_list):
-        """Merge multiple PDFs into one"""
-        merger = PdfMerger()
-        for pdf_data in pdf_list:
-            merger.append(BytesIO(pdf_data))
+        """Merge multiple PDFs into one temporary file and return its path (caller removes it)"""
+        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as output:
+            output_path = output.name
         
-        output = BytesIO()
-        merger.write(output)
-        merger.close()
+        # Sources must stay open until the merged file is saved (pages are copied lazily)
+        sources = []
+        try:
+            # Opened one by one so a corrupt PDF still closes the earlier ones and removes the temp file
+            for pdf_data in pdf_list:
+                sources.append(pikepdf.Pdf.open(BytesIO(pdf_data)))
+            
+            with pikepdf.Pdf.new() as merged:
+                for source in sources:
+                    merged.pages.extend(source.pages)
+                merged.save(output_path)
+        except Exception:
+            os.remove(output_path)
+            raise
+        finally:
+            for source in sources:
+                source.close()
         
-        output.seek(0)
-        return output.read()
+        return output_path
     
     def upload_to_supabase(self, file_data, filename, bucket):
-        """Upload file to Supabase storage bucket"""
+        """Upload file (bytes or an open binary file) to Supabase storage bucket"""
         try:
             filename = filename.strip()
             
-            existing = supabase.storage.from_(bucket).list(path='', options={'search': filename})
-            
-            if existing and len(existing) > 0:
-                return True
+            def upload():
+                # Retries must resend file objects from the start
+                if hasattr(file_data, 'seek'):
+                    file_data.seek(0)
+                return supabase.storage.from_(bucket).upload(
+                    filename,
+                    file_data,
+                    file_options={'content-type': 'application/pdf', 'upsert': False}
+                )
             
-            supabase.storage.from_(bucket).upload(
-                filename,
-                file_data,
-                file_options={'content-type': 'application/pdf', 'upsert': False}
-            )
+            try:
+                self._call_with_backoff(upload)
+            except Exception as e:
+                # Without upsert an existing file is rejected, which means it's already stored
+                if not _is_duplicate_upload(e):
+                    raise
             
             return True
             
         except Exception as e:
             return False
     
-    def process_single_email(self, message):
+    def process_single_email(self, email):
         """Process a single email message with Google Sheets logging"""
-        headers = message['payload'].get('headers', [])
-        subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
-        message_id = message['id']
+        subject = email.headers.get('Subject', 'No Subject')
+        message_id = email.id
         
-        print(f"\n{subject}")
+        logger.info(f"\n{subject}")
         
         company = ''
         invoice_filename = ''
         dot_filename = ''
         
         try:
-            company = self.extract_company_name(message)
+            company = self.extract_company_name(email)
             if not company:
                 error_msg = "Company name not found or not in Supabase"
                 self.log_to_sheet(message_id, subject, status='failed', error=error_msg)
-                self.failed_count += 1
+                self._increment('failed_count')
                 return
             
-            attachments = self.get_attachments(message)
+            attachments = self.get_attachments(email)
             if not attachments:
                 error_msg = "No PDF attachments found"
                 self.log_to_sheet(message_id, subject, company=company, status='failed', error=error_msg)
-                self.failed_count += 1
+                self._increment('failed_count')
                 return
             
             invoice_number = self.extract_invoice_number(attachments)
@@ -722,78 +997,159 @@ class FleetEmailProcessor:
             if not invoice_attachment:
                 error_msg = "No invoice file found"
                 self.log_to_sheet(message_id, subject, company=company, status='failed', error=error_msg)
-                self.failed_count += 1
+                self._increment('failed_count')
                 return
             
             invoice_metadata = self.extract_metadata_from_pdf(invoice_attachment['data'])
             unit = invoice_metadata['unit']
             vin = invoice_metadata['vin']
             plate = invoice_metadata['plate']
-            email_date = self.get_email_date(message)
+            email_date = self.get_email_date(email)
             
             if dot_attachments:
                 invoice_filename = f"{company}__I-{invoice_number}__U-{unit}__V-{vin}__D-{email_date}__P-{plate}.pdf".strip()
                 dot_filename = f"{company}__dot__I-{invoice_number}__U-{unit}__V-{vin}__D-{email_date}__P-{plate}.pdf".strip()
                 
                 invoice_uploaded = self.upload_to_supabase(invoice_attachment['data'], invoice_filename, 'INVOICE')
-                print(f"  INVOICE: {invoice_filename}")
+                logger.info(f"  INVOICE: {invoice_filename}")
                 
                 dot_pdfs = [att['data'] for att in dot_attachments]
-                merged_dot = self.merge_pdfs(dot_pdfs)
-                dot_uploaded = self.upload_to_supabase(merged_dot, dot_filename, 'DOT')
-                print(f"  DOT: {dot_filename}")
+                merged_dot_path = self.merge_pdfs(dot_pdfs)
+                try:
+                    # Stream the merged packet from disk instead of holding another copy in memory
+                    with open(merged_dot_path, 'rb') as merged_dot:
+                        dot_uploaded = self.upload_to_supabase(merged_dot, dot_filename, 'DOT')
+                finally:
+                    os.remove(merged_dot_path)
+                logger.info(f"  DOT: {dot_filename}")
                 
                 if invoice_uploaded and dot_uploaded:
                     moved = self.move_to_sorted_label(message_id)
                     self.log_to_sheet(message_id, subject, company=company, 
                                     invoice_file=invoice_filename, dot_file=dot_filename, 
                                     status='success')
-                    self.processed_count += 1
+                    self._increment('processed_count')
                 else:
                     error_msg = "Upload failed"
                     self.log_to_sheet(message_id, subject, company=company,
                                     invoice_file=invoice_filename, dot_file=dot_filename,
                                     status='failed', error=error_msg)
-                    self.failed_count += 1
+                    self._increment('failed_count')
             else:
                 invoice_filename = f"{company}__I-{invoice_number}__U-{unit}__V-{vin}__D-{email_date}__P-{plate}.pdf".strip()
                 
                 invoice_uploaded = self.upload_to_supabase(invoice_attachment['data'], invoice_filename, 'INVOICE')
-                print(f"  INVOICE: {invoice_filename}")
+                logger.info(f"  INVOICE: {invoice_filename}")
                 
                 if invoice_uploaded:
                     moved = self.move_to_sorted_label(message_id)
                     self.log_to_sheet(message_id, subject, company=company,
                                     invoice_file=invoice_filename, status='success')
-                    self.processed_count += 1
+                    self._increment('processed_count')
                 else:
                     error_msg = "Upload failed"
                     self.log_to_sheet(message_id, subject, company=company,
                                     invoice_file=invoice_filename, status='failed', error=error_msg)
-                    self.failed_count += 1
+                    self._increment('failed_count')
             
         except Exception as e:
             error_msg = str(e)
             self.log_to_sheet(message_id, subject, company=company,
                             invoice_file=invoice_filename, dot_file=dot_filename or 'N/A',
                             status='failed', error=error_msg)
-            self.failed_count += 1
+            self._increment('failed_count')
+    
+    def _batch_execute(self, requests, method='messages.get'):
+        """Run Gmail API requests through batch HTTP calls, returning {request_id: (response, error)}"""
+        results = {}
+        
+        def on_response(request_id, response, exception):
+            results[request_id] = (response, exception)
+        
+        pending = dict(requests)
+        for attempt in range(GMAIL_BATCH_RETRIES + 1):
+            request_ids = list(pending)
+            for start in range(0, len(request_ids), GMAIL_BATCH_LIMIT):
+                batch_ids = request_ids[start:start + GMAIL_BATCH_LIMIT]
+                batch = self.gmail_service.new_batch_http_request(callback=on_response)
+                for request_id in batch_ids:
+                    batch.add(pending[request_id], request_id=request_id)
+                # Every call inside the batch counts against the Gmail quota
+                self._gmail_execute(batch, method, calls=len(batch_ids))
+            
+            # Retry only the entries Gmail rejected for rate limits
+            pending = {rid: req for rid, req in pending.items() if _is_rate_limited(results[rid][1])}
+            if not pending or attempt == GMAIL_BATCH_RETRIES:
+                break
+            time.sleep(2 ** attempt)
+        
+        return results
+    
+    def _fetch_raw_email(self, msg_id):
+        """Fetch one raw RFC 822 message and parse it; the raw payload is dropped once parsed"""
+        message = self._gmail_execute(
+            self.gmail_service.users().messages().get(userId='me', id=msg_id, format='raw'), 'messages.get'
+        )
+        return EmailView.from_raw(message)
+    
+    def _handle_message(self, msg_id, position, fetched, rejection):
+        """Validate one fetched email, then clean it up or process it (runs on a worker thread)"""
+        try:
+            headers_view, error = fetched
+            if error:
+                raise error
+            
+            subject = headers_view.headers.get('Subject', 'No Subject')
+            logger.info(f"{position} {subject[:80]}")
+            
+            validation = rejection
+            if validation is None:
+                # Attachments are downloaded here, so at most MAX_WORKERS emails' PDFs are in memory
+                email = self._fetch_raw_email(msg_id)
+                validation = self.validate_attachments(email)
+            
+            if validation['action'] == 'move_to_original':
+                # Reply email - move back to original batch label
+                moved, error = self.move_reply_to_original_label(msg_id, validation['current_labels'])
+                self.log_to_sheet(msg_id, subject, status='failed', 
+                                 error=f"Reply email - {error}")
+                self._increment('cleaned_count')
+                
+            elif validation['action'] == 'move_to_other':
+                # Non-invoice email - move to Other label
+                moved = self.move_to_other_label(msg_id)
+                self.log_to_sheet(msg_id, subject, status='failed', 
+                                 error=validation['reason'])
+                self._increment('cleaned_count')
+                
+            elif validation['action'] == 'skip':
+                # Skip without moving
+                logger.info(f"  ⏭️  Skipped: {validation['reason']}")
+                self._increment('skipped_count')
+                
+            elif validation['should_process']:
+                # Process normally
+                self.process_single_email(email)
+            
+        except Exception as e:
+            logger.error(f"{position} ✗ Error: {e}")
+            self._increment('failed_count')
     
     def process_inbox(self, limit=None):
         """Process all emails in inbox with cleanup for replies and non-invoices"""
-        print("FLEET EMAIL PROCESSOR - GOOGLE SHEETS VERSION")
-        print("="*60)
+        logger.info("FLEET EMAIL PROCESSOR - GOOGLE SHEETS VERSION")
+        logger.info("="*60)
         
         all_messages = []
         page_token = None
         
         while True:
-            results = self.gmail_service.users().messages().list(
+            results = self._gmail_execute(self.gmail_service.users().messages().list(
                 userId='me',
                 labelIds=['INBOX'],
                 pageToken=page_token,
-                maxResults=100
-            ).execute()
+                maxResults=GMAIL_LIST_PAGE_SIZE
+            ), 'messages.list')
             
             messages = results.get('messages', [])
             all_messages.extend(messages)
@@ -809,73 +1165,75 @@ class FleetEmailProcessor:
         # Count already processed
         already_processed = sum(1 for msg in all_messages if self._is_already_processed(msg['id']))
         
-        print(f"Total emails in inbox: {total}")
-        print(f"Already processed (success in sheet): {already_processed}")
-        print(f"Will attempt to process: {len(all_messages) - already_processed}")
-        print("="*60)
+        logger.info(f"Total emails in inbox: {total}")
+        logger.info(f"Already processed (success in sheet): {already_processed}")
+        logger.info(f"Will attempt to process: {len(all_messages) - already_processed}")
+        logger.info("="*60)
         
-        for idx, msg in enumerate(all_messages, 1):
-            msg_id = msg['id']
-            
-            if self._is_already_processed(msg_id):
-                self.skipped_count += 1
-                continue
-            
-            print(f"[{idx}/{len(all_messages)}]", end=" ")
-            
-            try:
-                message = self.gmail_service.users().messages().get(
-                    userId='me',
-                    id=msg_id
-                ).execute()
-                
-                headers = message['payload'].get('headers', [])
-                subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
-                print(f"{subject[:80]}")
-                
-                validation = self.validate_email(message)
-                
-                if validation['action'] == 'move_to_original':
-                    # Reply email - move back to original batch label
-                    moved, error = self.move_reply_to_original_label(msg_id, validation['current_labels'])
-                    self.log_to_sheet(msg_id, subject, status='failed', 
-                                     error=f"Reply email - {error}")
-                    self.cleaned_count += 1
+        try:
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                # Fetch messages in Gmail batch requests instead of one round trip each
+                for start in range(0, len(all_messages), GMAIL_BATCH_LIMIT):
+                    chunk = all_messages[start:start + GMAIL_BATCH_LIMIT]
+                    futures = []
+                    
+                    # Pass 1: headers only, enough to reject replies and non-invoice mail
+                    pending_ids = [msg['id'] for msg in chunk if not self._is_already_processed(msg['id'])]
+                    try:
+                        responses = self._batch_execute({
+                            msg_id: self.gmail_service.users().messages().get(
+                                userId='me', id=msg_id, format='metadata', metadataHeaders=METADATA_HEADERS
+                            )
+                            for msg_id in pending_ids
+                        })
+                    except Exception as e:
+                        # One bad batch only fails its own messages - carry on with the next chunk
+                        logger.error(f"[{start + 1}-{start + len(chunk)}/{len(all_messages)}] ✗ Error fetching chunk: {e}")
+                        for _ in pending_ids:
+                            self._increment('failed_count')
+                        continue
+                    fetched = {
+                        msg_id: (None if error else EmailView.from_message(message), error)
+                        for msg_id, (message, error) in responses.items()
+                    }
+                    rejections = {
+                        msg_id: self.validate_headers(headers_view)
+                        for msg_id, (headers_view, error) in fetched.items()
+                        if not error
+                    }
                     
-                elif validation['action'] == 'move_to_other':
-                    # Non-invoice email - move to Other label
-                    moved = self.move_to_other_label(msg_id)
-                    self.log_to_sheet(msg_id, subject, status='failed', 
-                                     error=validation['reason'])
-                    self.cleaned_count += 1
+                    for idx, msg in enumerate(chunk, start + 1):
+                        msg_id = msg['id']
+                        
+                        if msg_id not in fetched:
+                            self._increment('skipped_count')
+                            continue
+                        
+                        futures.append(executor.submit(
+                            self._handle_message,
+                            msg_id,
+                            f"[{idx}/{len(all_messages)}]",
+                            fetched[msg_id],
+                            rejections.get(msg_id)
+                        ))
                     
-                elif validation['action'] == 'skip':
-                    # Skip without moving
-                    print(f"  ⏭️  Skipped: {validation['reason']}")
-                    self.skipped_count += 1
+                    # Finish the chunk before reading the sheet cache for the next one
+                    for future in as_completed(futures):
+                        future.result()
                     
-                elif validation['should_process']:
-                    # Process normally
-                    self.process_single_email(message)
-                
-                # Rate limiting
-                if idx < len(all_messages):
-                    if idx % BATCH_SIZE == 0:
-                        time.sleep(BATCH_DELAY)
-                    else:
-                        time.sleep(DELAY_BETWEEN_EMAILS)
-                
-            except Exception as e:
-                print(f"  ✗ Error: {e}")
-                self.failed_count += 1
-        
-        print("\n" + "="*60)
-        print("COMPLETE")
-        print(f"Processed: {self.processed_count}")
-        print(f"Cleaned up: {self.cleaned_count}")
-        print(f"Skipped: {self.skipped_count}")
-        print(f"Failed: {self.failed_count}")
-        print("="*60)
+                    # Sheet rows and their label moves wait for a full buffer
+                    self.flush_pending()
+        finally:
+            # Workers are done by now - never leave queued moves or rows unsent
+            self.flush_pending(force=True)
+        
+        logger.info("\n" + "="*60)
+        logger.info("COMPLETE")
+        logger.info(f"Processed: {self.processed_count}")
+        logger.info(f"Cleaned up: {self.cleaned_count}")
+        logger.info(f"Skipped: {self.skipped_count}")
+        logger.info(f"Failed: {self.failed_count}")
+        logger.info("="*60)
 
 if __name__ == "__main__":
     processor = FleetEmailProcessor()